@@ -12,21 +12,65 @@
 #:          Choosing the right tile to be "on top" of the output raster is the
 #:          main logical task of the program.
 
+import argparse
+import contextlib
 import csv
 import datetime
+import itertools
+import math
 import os
 import sys
 import shutil
+import time
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 
 
+#: Columns of the table holding the information about every tile. Cells are
+#: identified by their integer x/y fishnet indices; the 'x-y' string is only
+#: built for the fishnet layer and the tile file names. The tile's footprint
+#: and resolution are kept so the tile index doesn't have to open every tile.
+TILE_BOUNDS_COLUMNS = ['tile_xmin', 'tile_ymin', 'tile_xmax', 'tile_ymax', 'res_x', 'res_y']
+TILE_COLUMNS = ['cell_x', 'cell_y', 'tile_rastername', 'distance', 'nodatas', 'override'] + TILE_BOUNDS_COLUMNS
+
+#: Layers of the mosaic GeoPackage: the tile footprints in each fishnet cell
+#: (edited by the user to force tiles to the top) and the source rasters'
+#: extents
+FISHNET_LAYER = 'fishnet'
+EXTENTS_LAYER = 'extents'
+
+
+def build_progress_statuses():
+    '''
+    Builds every status string for the progress bar, indexed by the number of
+    the 40 stops that are done: 0...10...20... - done.
+    '''
+    statuses = []
+    for done in range(0, 41):
+        status = ''
+        for i in range(0, done):
+            if i % 4 == 0:
+                status += str(int(i / 4 * 10))
+            else:
+                status += '.'
+        if done == 40:
+            status += '100 - done.\n'
+        statuses.append(status)
+
+    return statuses
+
+
+PROGRESS_STATUSES = build_progress_statuses()
+
+
 #: GDAL callback method that seems to work, as per
 #: https://gis.stackexchange.com/questions/237479/using-callback-with-python-gdal-rasterizelayer
 def gdal_progress_callback(complete, message, unknown):
@@ -34,24 +78,33 @@ def gdal_progress_callback(complete, message, unknown):
     Progress bar styled after the default GDAL progress bars. Uses specific
     signature to conform with GDAL core.
     '''
-    #: 40 stops on our progress bar, so scale to 40
-    done = int(40 * complete / 1)
+    #: 40 stops on our progress bar, so scale to 40 (GDAL sometimes reports
+    #: a little over 100%)
+    done = min(int(40 * complete / 1), len(PROGRESS_STATUSES) - 1)
 
-    #: Build string: 0...10...20... - done.
-    status = ''
-    for i in range(0, done):
-        if i % 4 == 0:
-            status += str(int(i / 4 * 10))
-        else:
-            status += '.'
-    if done == 40:
-        status += '100 - done.\n'
+    #: GDAL calls this far more often than the bar changes, so only write
+    #: when it reaches a new stop (reset_progress() starts a new bar)
+    if done == gdal_progress_callback.last_done:
+        return 1
+    gdal_progress_callback.last_done = done
 
-    sys.stdout.write('\r{}'.format(status))
+    sys.stdout.write('\r{}'.format(PROGRESS_STATUSES[done]))
     sys.stdout.flush()
     return 1
 
 
+gdal_progress_callback.last_done = None
+
+
+def reset_progress():
+    '''
+    Start a new progress bar: call before each operation that reports through
+    gdal_progress_callback so that its first stop is always written, even if
+    it's the same stop the previous bar finished on (ie, 100%).
+    '''
+    gdal_progress_callback.last_done = None
+
+
 def ceildiv(first, second):
     '''
     Ceiling division, from user dlitz, https://stackoverflow.com/a/17511341/674039
@@ -59,37 +112,41 @@ def ceildiv(first, second):
     return -(-first // second)
 
 
-def get_bounding_box(in_path):
+def get_raster_info(in_path):
     '''
-    Gets the extent of a GDAL-supported raster in map units
+    Gets the information needed to tile a GDAL-supported raster with a
+    single open of the raster.
+
+    Returns: (geotransform, x size in pixels, y size in pixels, nodata value
+    of the first band, GDAL data type of the first band)
     '''
 
     s_fh = gdal.Open(in_path, gdal.GA_ReadOnly)
     trans = s_fh.GetGeoTransform()
-    ulx = trans[0]
-    uly = trans[3]
-    # Calculate lower right x/y with rows/cols * cell size + origin
-    lrx = s_fh.RasterXSize * trans[1] + ulx
-    lry = s_fh.RasterYSize * trans[5] + uly
+    x_size = s_fh.RasterXSize
+    y_size = s_fh.RasterYSize
+    band1 = s_fh.GetRasterBand(1)
+    nodata = band1.GetNoDataValue()
+    data_type = band1.DataType
+    band1 = None
 
     s_fh = None
 
-    return (ulx, uly, lrx, lry)
+    return (trans, x_size, y_size, nodata, data_type)
 
 
 def create_fishnet_indices(ulx, uly, lrx, lry, dimension, pixels=False, pixel_size=2.5):
     '''
-    Creates a list of indices that cover the given bounding box (may extend
+    Creates a record array of cells that cover the given bounding box (may extend
     beyond the lrx/y point) with a spacing specified by 'dimension'.
     If pixels is true, assumes dimensions are in pixels and uses pixel_size.
     Otherwise, dimension is in raster coordinate system.
 
-    Returns:    list of tuples (x fishnet index, y fishnet index, cell ulx,
-                cell uly, cell lrx, cell lry)
+    Returns:    numpy record array with one record per cell and the fields
+                xi (x fishnet index), yi (y fishnet index), ulx, uly, lrx, lry
+                (cell bounding box)
     '''
 
-    cells = []
-
     ref_width = lrx - ulx
     ref_height = uly - lry
     if pixels:
@@ -98,23 +155,28 @@ def create_fishnet_indices(ulx, uly, lrx, lry, dimension, pixels=False, pixel_si
         cell_ref_size = dimension
     num_x_cells = int(ceildiv(ref_width, cell_ref_size))
     num_y_cells = int(ceildiv(ref_height, cell_ref_size))
-    for y_cell in range(0, num_y_cells):
-        for x_cell in range(0, num_x_cells):
-            x_index = x_cell
-            y_index = y_cell
-            cell_ulx = ulx + (cell_ref_size * x_index)
-            cell_uly = uly + (-cell_ref_size * y_index)
-            cell_lrx = ulx + (cell_ref_size * (x_index + 1))
-            cell_lry = uly + (-cell_ref_size * (y_index + 1))
-            cells.append((x_index, y_index, cell_ulx, cell_uly, cell_lrx,
-                           cell_lry))
+
+    #: Build the indices of every cell at once; rows of the meshgrid are y, so
+    #: flattening them keeps the cells in row-major (y, then x) order
+    x_indices, y_indices = np.meshgrid(np.arange(num_x_cells),
+                                       np.arange(num_y_cells))
+    x_indices = x_indices.ravel()
+    y_indices = y_indices.ravel()
+
+    cells = np.rec.fromarrays([x_indices,
+                               y_indices,
+                               ulx + (cell_ref_size * x_indices),
+                               uly + (-cell_ref_size * y_indices),
+                               ulx + (cell_ref_size * (x_indices + 1)),
+                               uly + (-cell_ref_size * (y_indices + 1))],
+                              names='xi,yi,ulx,uly,lrx,lry')
 
     return cells
 
 
 def create_polygon(coords):
     '''
-    Creates a WKT polygon from a list of coordinates
+    Creates an OGR polygon geometry from a list of coordinates
     coords: [(x1,y1), (x2,y2), (xn,yn)..., (x1,y1)]
     '''
     ring = ogr.Geometry(ogr.wkbLinearRing)
@@ -124,276 +186,231 @@ def create_polygon(coords):
     # Create polygon
     poly = ogr.Geometry(ogr.wkbPolygon)
     poly.AddGeometry(ring)
-    return poly.ExportToWkt()
+    return poly
 
 
-def copy_tiles_from_raster(root, rastername, fishnet, shp_layer, target_dir):
+def overlapping_cells(fishnet, raster_info):
     '''
-    Given a fishnet of a certain size, copy any portions of a single source
-    raster into individual tiles with the same extent as the fishnet cells.
-    Calculates the distance from the cell center to the raster's center, and
-    stores in the fishnet shapefile containing the bounding box of each cell.
+    Find the fishnet cells that overlap a raster with a bounding box
+    intersection over the whole fishnet at once (this also catches cells
+    that completely contain the raster).
 
-    Returns a double nested dictionary containing the information for each tile
-    in the form:
-    {cell_index:
-        {tile_rastername:
-            {'distance':x,
-             'nodatas':y,
-             'override':True/False}
-        }
-    }
+    Returns: the overlapping rows of the fishnet record array.
     '''
 
-    cells = {}
+    trans, raster_xsize, raster_ysize, _, _ = raster_info
+    raster_xmin = trans[0]
+    raster_ymax = trans[3]
+    raster_xmax = raster_xsize * trans[1] + raster_xmin
+    raster_ymin = raster_ysize * trans[5] + raster_ymax
 
-    raster_path = os.path.join(root, rastername)
+    overlaps = ((fishnet.ulx < raster_xmax) & (fishnet.lrx > raster_xmin) &
+                (fishnet.lry < raster_ymax) & (fishnet.uly > raster_ymin))
 
-    # Get data from source raster
-    s_fh = gdal.Open(raster_path, gdal.GA_ReadOnly)
-    trans = s_fh.GetGeoTransform()
-    projection = s_fh.GetProjection()
-    band1 = s_fh.GetRasterBand(1)
-    s_nodata = band1.GetNoDataValue()
-    if not s_nodata:
+    return fishnet[overlaps]
+
+
+def copy_tiles_from_raster(raster_path, raster_info, cells, target_dir, tile_type):
+    '''
+    Given the fishnet cells that overlap a single source raster (see
+    overlapping_cells()), create individual VRT tiles that reference the
+    portions of the raster with the same extent as the cells.
+    Calculates the distance from the cell center to the raster's center.
+    Doesn't touch any shared state so it can be run in a separate process
+    for each raster.
+    raster_info is the raster's tuple from get_raster_info() so that its
+    metadata doesn't have to be read again. tile_type is the GDAL data type
+    for the tiles. If target_dir is in /vsimem, the tiles aren't written at
+    all but are returned for the calling process to write (/vsimem is
+    private to each process).
+
+    Returns a tuple of (tiles, features, tile_vrts).
+    tiles is a dictionary of lists, one for each of TILE_COLUMNS, containing
+    the information for each tile in the form:
+    {'cell_x': [x fishnet index, ...],
+     'cell_y': [y fishnet index, ...],
+     'tile_rastername': [tile_rastername, ...],
+     'distance': [x, ...],
+     'nodatas': [y, ...],
+     'override': [False, ...],
+     'tile_xmin': [tile footprint xmin, ...],
+     ... (the rest of TILE_BOUNDS_COLUMNS)}
+    features is a list of tuples of the fields and bounding box coordinates of
+    each tile's cell for the fishnet layer:
+    [(rastername, cell_x, cell_y, distance, nodatas, coords, bounds), ...]
+    where bounds is the tile's values for TILE_BOUNDS_COLUMNS.
+    tile_vrts is a list of (tile_rastername, VRT XML) for an in-memory
+    target_dir and is empty otherwise.
+    '''
+
+    tiles = {column: [] for column in TILE_COLUMNS}
+    features = []
+    tile_vrts = []
+    in_memory = target_dir.startswith('/vsimem/')
+
+    rastername = os.path.basename(raster_path)
+
+    # Get data about source raster
+    trans, raster_xsize, raster_ysize, s_nodata, _ = raster_info
+    #: Only use 256 if there's no nodata value; 0 is a valid nodata value
+    if s_nodata is None:
         s_nodata = 256
-    bands = s_fh.RasterCount
     raster_xmin = trans[0]
     raster_ymax = trans[3]
     raster_xwidth = trans[1]
     raster_yheight = trans[5]
-    #driver = s_fh.GetDriver()
-    driver = gdal.GetDriverByName("GTiff")
-    lzw_opts = ["compress=lzw", "tiled=yes"]
-    band1 = None
-
-    # Calculate lower right x/y with rows/cols * cell size + origin
-    raster_xmax = s_fh.RasterXSize * raster_xwidth + raster_xmin
-    raster_ymin = s_fh.RasterYSize * raster_yheight + raster_ymax
 
     # Calculate raster middle
-    raster_xmid = (s_fh.RasterXSize / 2.) * raster_xwidth + raster_xmin
-    raster_ymid = (s_fh.RasterYSize / 2.) * raster_yheight + raster_ymax
+    raster_xmid = (raster_xsize / 2.) * raster_xwidth + raster_xmin
+    raster_ymid = (raster_ysize / 2.) * raster_yheight + raster_ymax
 
-    # Loop through the cells in the fishnet, copying over any relevant bits of
-    # raster to new subchunks.
-    for cell in fishnet:
+    # Only open the source raster once we know it has a tile to create
+    s_fh = None
 
-        cell_index = "{}-{}".format(cell[0], cell[1])
-        cell_xmin = cell[2]
-        cell_xmax = cell[4]
-        cell_ymin = cell[5]
-        cell_ymax = cell[3]
+    # Translate all the cells' coords to raster pixels at once
+    # Fishnet cell origin and size as pixel indices (astype truncates like
+    # int() does)
+    x_offs = ((cells.ulx - raster_xmin) / raster_xwidth).astype(np.int64)
+    y_offs = ((cells.uly - raster_ymax) / raster_yheight).astype(np.int64)
+    # Add 5 pixels to x/y_size to handle gaps
+    x_sizes = ((cells.lrx - cells.ulx) / raster_xwidth).astype(np.int64) + 5
+    y_sizes = ((cells.lry - cells.uly) / raster_yheight).astype(np.int64) + 5
+
+    # Edge logic for the ReadAsArray windows (in pixels)
+    # If read exceeds bounds of image, clamp x/y offset and end so we only
+    # read the part of the cell that's inside the raster.
+    read_x_offs = np.maximum(x_offs, 0)
+    read_y_offs = np.maximum(y_offs, 0)
+    read_x_sizes = np.minimum(x_offs + x_sizes, raster_xsize) - read_x_offs
+    read_y_sizes = np.minimum(y_offs + y_sizes, raster_ysize) - read_y_offs
+
+    #: One row of plain ints per cell:
+    #: [x_off, y_off, x_size, y_size, read_x_off, read_y_off, read_x_size,
+    #:  read_y_size]
+    windows = np.column_stack((x_offs, y_offs, x_sizes, y_sizes,
+                               read_x_offs, read_y_offs, read_x_sizes,
+                               read_y_sizes)).tolist()
+
+    for cell, window in zip(cells, windows):
+
+        cell_x = int(cell.xi)
+        cell_y = int(cell.yi)
+        cell_xmin = cell.ulx
+        cell_xmax = cell.lrx
+        cell_ymin = cell.lry
+        cell_ymax = cell.uly
 
         cell_xmid = (cell_xmax - cell_xmin) / 2. + cell_xmin
         cell_ymid = (cell_ymax - cell_ymin) / 2. + cell_ymin
 
-        # Check to see if some part of raster is inside a given fishnet
-        # cell.
-        # If cell x min or max and y min or max are inside the raster
-        xmin_inside = cell_xmin > raster_xmin and cell_xmin < raster_xmax
-        xmax_inside = cell_xmax > raster_xmin and cell_xmax < raster_xmax
-        ymin_inside = cell_ymin > raster_ymin and cell_ymin < raster_ymax
-        ymax_inside = cell_ymax > raster_ymin and cell_ymax < raster_ymax
-        if (xmin_inside or xmax_inside) and (ymin_inside or ymax_inside):
-
-            # Translate cell coords to raster pixels, create a numpy array
-            # intialized to nodatas, readasarray, save as cell_raster.tif
-
-            #print("{} {} {} {}".format(cell_xmin, raster_xmin, cell_ymax, raster_ymax))
-
-            # Fishnet cell origin and size as pixel indices
-            x_off = int((cell_xmin - raster_xmin) / raster_xwidth)
-            y_off = int((cell_ymax - raster_ymax) / raster_yheight)
-            # Add 5 pixels to x/y_size to handle gaps
-            x_size = int((cell_xmax - cell_xmin) / raster_xwidth) + 5
-            y_size = int((cell_ymin - cell_ymax) / raster_yheight) + 5
-
-            #print("{} {} {} {}".format(x_off, y_off, x_size, y_size))
-
-            # Values for ReadAsArray, these aren't changed later unless
-            # the border case checks change them
-            # These are all in pixels
-            # We are adding two to read_x/y_size to slightly overread to
-            # catch small one or two pixel gaps in the combined rasters.
-            read_x_off = x_off
-            read_y_off = y_off
-            read_x_size = x_size
-            read_y_size = y_size
-
-            # Slice values for copying read data into slice_array
-            # These are the indices in the slice array where the actual
-            # read data should be copied to.
-            # These should be 0 and max size (ie, same dimension as
-            # read_array) unelss the border case checks change them.
-            sa_x_start = 0
-            sa_x_end = x_size
-            sa_y_start = 0
-            sa_y_end = y_size
-
-            # Edge logic
-            # If read exceeds bounds of image:
-            #   Adjust x/y offset to appropriate place
-            #   Change slice indices
-            # Checks both x and y, setting read and slice values for each dimension if
-            # needed
-            if x_off < 0:
-                read_x_off = 0
-                read_x_size = x_size + x_off  # x_off would be negative
-                sa_x_start = -x_off  # shift inwards -x_off spaces
-            if x_off + x_size > s_fh.RasterXSize:
-                read_x_size = s_fh.RasterXSize - x_off
-                sa_x_end = read_x_size  # end after read_x_size spaces
-
-            if y_off < 0:
-                read_y_off = 0
-                read_y_size = y_size + y_off
-                sa_y_start = -y_off
-            if y_off + y_size > s_fh.RasterYSize:
-                read_y_size = s_fh.RasterYSize - y_off
-                sa_y_end = read_y_size
-
-            # Set up output raster
-            tile_rastername = "{}_{}.tif".format(cell_index, rastername[:-4])
-            #print(tile_rastername)
-            t_path = os.path.join(target_dir, tile_rastername)
-            t_fh = driver.Create(t_path, x_size, y_size, bands, gdal.GDT_Int16, options=lzw_opts)
-            t_fh.SetProjection(projection)
-
-            # TO FIX WEIRD OFFSETS:
-            # Make sure tranform is set based on the top left corner of top
-            # left pixel of the source raster, not the fishnet. Using fishnet
-            # translates the whole raster to the fishnet's grid, which isn't
-            # consistent with the rasters' pixel grids.
-            # i.e., cell_x/ymin is not the top left corner of top left pixel of the raster
-
-            # Translate from x/y_off (pixels) to raster's GCS
-            raster_chunk_xmin = x_off * raster_xwidth + raster_xmin
-            raster_chunk_ymax = y_off * raster_yheight + raster_ymax
-
-            # Transform:
-            # 0: x coord, top left corner of top left pixel
-            # 1: pixel width
-            # 2: 0 (for north up)
-            # 3: y coord, top left corner of top left pixel
-            # 4: 0 (for north up)
-            # 5: pixel height
-            # t_trans = (cell_xmin, raster_xwidth, 0, cell_ymax, 0, raster_yheight)
-            t_trans = (raster_chunk_xmin, raster_xwidth, 0, raster_chunk_ymax, 0, raster_yheight)
-            t_fh.SetGeoTransform(t_trans)
-
-            num_nodata = 0
-            # Loop through all the bands of the raster and copy to a new chunk
-            for band in range(1, bands + 1):
-                # Prep target band
-                t_band = t_fh.GetRasterBand(band)
-                if s_nodata:
-                    t_band.SetNoDataValue(s_nodata)
-
-                # Initialize slice array to nodata (for areas of the new chunk
-                # that are outside the source raster)
-                slice_array = np.full((y_size, x_size), s_nodata)
-
-                # Read the source raster
-                s_band = s_fh.GetRasterBand(band)
-                read_array = s_band.ReadAsArray(read_x_off, read_y_off,
-                                                read_x_size, read_y_size)
-
-                num_nodata += (read_array == s_nodata).sum()
-                # Put source raster data into appropriate place of slice array
-                slice_array[sa_y_start:sa_y_end, sa_x_start:sa_x_end] = read_array
-
-                # Write source array to disk
-                t_band.WriteArray(slice_array)
-                t_band = None
-                s_band = None
-
-            # Close target file handle
-            t_fh = None
-
-            # Calculate distance from cell center to raster center
-            cell_center = np.array((cell_xmid, cell_ymid))
-            raster_center = np.array((raster_xmid, raster_ymid))
-            distance = np.linalg.norm(cell_center - raster_center)
-
-            new_num_nodata = num_nodata / 3.
-
-            # print("{}, {}, {}, {}".format(cell_index, rastername, distance, new_num_nodata))
-
-            # Create cell bounding boxes as shapefile, with distance from the
-            # middle of the cell to the middle of it's parent raster saved as a
-            # field for future evaluation
-            coords = [(cell_xmin, cell_ymax),
-                      (cell_xmax, cell_ymax),
-                      (cell_xmax, cell_ymin),
-                      (cell_xmin, cell_ymin),
-                      (cell_xmin, cell_ymax)]
-            defn = shp_layer.GetLayerDefn()
-            feature = ogr.Feature(defn)
-            feature.SetField('raster', rastername)
-            feature.SetField('cell', cell_index)
-            feature.SetField('d_to_cent', distance)
-            feature.SetField('nodatas', new_num_nodata)
-            poly = create_polygon(coords)
-            geom = ogr.CreateGeometryFromWkt(poly)
-            feature.SetGeometry(geom)
-            shp_layer.CreateFeature(feature)
-            feature = None
-            poly = None
-            geom = None
-
-            #: distances is a nested dictionary. First key is cell index. Each
-            #: cell index is a dictionary of the different source raster chunk
-            #: for that cell. The inner key is the source raster chunk file name
-
-            #: TODO: I may not need the cell name, may make sense to flatten to
-            #: a list of nested dicts rather than a double-nested dict (still
-            #: need some sort of separation so that sorting occurs at a cell-
-            #: level)
-            if cell_index not in cells:
-                cells[cell_index] = {}
-            cells[cell_index][tile_rastername] = {'distance': distance,
-                                                  'nodatas': new_num_nodata,
-                                                  'override': False
-                                                 }
-
-            # tile_key = t_rastername[:-4]
-            # distances[tile_key] = {'index': cell_index,
-            #                        'raster': rastername,
-            #                        'distance': distance,
-            #                        'nodatas': new_num_nodata,
-            #                        'tile': tile_key
-            #                        }
+        (x_off, y_off, x_size, y_size,
+         read_x_off, read_y_off, read_x_size, read_y_size) = window
+
+        # Set up output tile. The tile is a VRT that references the
+        # source window rather than a copy of the pixels, so GDAL handles
+        # the clipping and nodata padding when the final mosaic is read.
+        # srcWin keeps the tile on the source raster's pixel grid, which
+        # avoids the weird offsets caused by snapping to the fishnet.
+        if s_fh is None:
+            s_fh = gdal.Open(raster_path, gdal.GA_ReadOnly)
+        tile_rastername = "{}-{}_{}.vrt".format(cell_x, cell_y, rastername[:-4])
+        t_path = os.path.join(target_dir, tile_rastername)
+        trans_opts = gdal.TranslateOptions(format='VRT',
+                                           srcWin=[x_off, y_off, x_size, y_size],
+                                           noData=s_nodata,
+                                           outputType=tile_type)
+        # The widened windows of cells along the raster's edges run off the
+        # raster, which is expected, so don't let GDAL warn about each one.
+        gdal.PushErrorHandler('CPLQuietErrorHandler')
+        try:
+            if in_memory:
+                t_fh = gdal.Translate('', s_fh, options=trans_opts)
+            else:
+                t_fh = gdal.Translate(t_path, s_fh, options=trans_opts)
+        finally:
+            gdal.PopErrorHandler()
+        if t_fh is None:
+            raise RuntimeError(f'Could not create tile {tile_rastername} from {raster_path} '
+                               f'(srcWin {x_off}, {y_off}, {x_size}, {y_size}): {gdal.GetLastErrorMsg()}')
+        if in_memory:
+            tile_vrts.append((tile_rastername, t_fh.GetMetadata('xml:VRT')[0]))
+        t_fh = None
+
+        # Count the nodatas in the part of the source raster covered by
+        # this cell. Reading from the dataset reads all the bands in one
+        # call as a (bands, y, x) array.
+        read_array = s_fh.ReadAsArray(read_x_off, read_y_off,
+                                      read_x_size, read_y_size)
+        num_nodata = np.count_nonzero(read_array == s_nodata)
+
+        # Calculate distance from cell center to raster center
+        distance = math.hypot(cell_xmid - raster_xmid, cell_ymid - raster_ymid)
+
+        # The tile's footprint comes straight from its source window
+        tile_xmin = x_off * raster_xwidth + raster_xmin
+        tile_ymax = y_off * raster_yheight + raster_ymax
+        tile_xmax = x_size * raster_xwidth + tile_xmin
+        tile_ymin = y_size * raster_yheight + tile_ymax
+        bounds = (tile_xmin, tile_ymin, tile_xmax, tile_ymax, raster_xwidth, abs(raster_yheight))
+
+        # Create cell bounding boxes for the fishnet layer, with distance from
+        # the middle of the cell to the middle of it's parent raster saved
+        # as a field for future evaluation
+        coords = [(cell_xmin, cell_ymax),
+                  (cell_xmax, cell_ymax),
+                  (cell_xmax, cell_ymin),
+                  (cell_xmin, cell_ymin),
+                  (cell_xmin, cell_ymax)]
+        features.append((rastername, cell_x, cell_y, distance, num_nodata, coords, bounds))
+
+        tiles['cell_x'].append(cell_x)
+        tiles['cell_y'].append(cell_y)
+        tiles['tile_rastername'].append(tile_rastername)
+        tiles['distance'].append(distance)
+        tiles['nodatas'].append(num_nodata)
+        tiles['override'].append(False)
+        for column, value in zip(TILE_BOUNDS_COLUMNS, bounds):
+            tiles[column].append(value)
 
     # close source raster
     s_fh = None
 
-    return cells
+    return tiles, features, tile_vrts
+
+
+def init_tiling_worker():
+    '''
+    Initializer for the tiling worker processes. Bounds GDAL's block cache so
+    that a worker per core doesn't each claim GDAL's default share of RAM.
+    '''
+    gdal.SetCacheMax(256 * 1024 * 1024)
 
 
-def generate_tiles_from_rasters(rectified_dir, extents_path, shp_path, tiled_dir, fishnet_size):
+def generate_tiles_from_rasters(rectified_dir, gpkg_path, tiled_dir, fishnet_size, pool=None, tiling_workers=None):
     '''
     Tiles all the rasters in rectified_dir into tiles based on a fishnet
     starting at the upper left of all the rasters and that has cells of
     fishnet_size, saving them in tiled_dir. Each fishnet cell will have
     multiple tiles associated with it if two or more rasters overlap. The
     following information is calculated for each tile, stored in the fishnet
-    shapefile, and returned from the method: the parent raster, the fishnet
-    cell index, the distance from the center of the tile to the center of the
-    parent raster, and the number of nodata pixels in the tile.
-
-    Returns: A double-nested dictionary built from similarly-formated
-    dictionaries from copy_tiles_from_raster() containing all the information
-    about each cell, formatted like thus:
-    {cell_index:
-        {tile_rastername:
-            {'distance':x,
-             'nodatas':y,
-             'override':True/False}
-        }
-    }
+    layer of the gpkg_path GeoPackage (next to the source rasters' extents),
+    and returned from the method: the parent raster, the fishnet cell index,
+    the distance from the center of the tile to the center of the parent
+    raster, and the number of nodata pixels in the tile.
+
+    The rasters are tiled in pool, a ProcessPoolExecutor initialized with
+    init_tiling_worker(), if given; otherwise a pool of tiling_workers
+    processes (default: one per core) is created (and shut down) just for
+    this call.
+
+    Returns: A pandas DataFrame with TILE_COLUMNS as columns and a row for
+    every tile, built from the lists returned by copy_tiles_from_raster().
     '''
 
+    #: {raster_path: (geotransform, x size, y size, nodata, data type)}, read once here
+    #: and passed to the tiling so that it doesn't have to get it again
+    rasters = {}
+
     #: {filename:[(xmin, ymax),
     #:            (xmax, ymax),
     #:            (xmax, ymin),
@@ -411,148 +428,165 @@ def generate_tiles_from_rasters(rectified_dir, extents_path, shp_path, tiled_dir
     lrx = 0
     # lry is smallest y, so we set high and check if lower
     lry = 999999999
-    for root, _, files in os.walk(rectified_dir):
-        for fname in files:
-            if fname[-4:] == ".tif":
-                img_path = os.path.join(root, fname)
-                xmin, ymax, xmax, ymin = get_bounding_box(img_path)
-
-                if xmin < ulx:
-                    ulx = xmin
-                if ymax > uly:
-                    uly = ymax
-                if xmax > lrx:
-                    lrx = xmax
-                if ymin < lry:
-                    lry = ymin
-
-                #: Add to extents dictionary
-                extents[fname] = [(xmin, ymax),
+    for img_path in Path(rectified_dir).rglob('*.tif'):
+        raster_info = get_raster_info(str(img_path))
+        rasters[str(img_path)] = raster_info
+
+        # Calculate the bounding box from the raster's origin and size
+        trans, x_size, y_size, _, _ = raster_info
+        xmin = trans[0]
+        ymax = trans[3]
+        xmax = x_size * trans[1] + xmin
+        ymin = y_size * trans[5] + ymax
+
+        if xmin < ulx:
+            ulx = xmin
+        if ymax > uly:
+            uly = ymax
+        if xmax > lrx:
+            lrx = xmax
+        if ymin < lry:
+            lry = ymin
+
+        #: Add to extents dictionary
+        extents[img_path.name] = [(xmin, ymax),
                                   (xmax, ymax),
                                   (xmax, ymin),
                                   (xmin, ymin),
                                   (xmin, ymax)]
-    # print("{}, {}; {}, {}".format(ulx, uly, lrx, lry))
 
     epsg_code = 26912
     #epsg_code = 32612
 
-    #: Set up extents shapefile
-    shp_driver = ogr.GetDriverByName('ESRI Shapefile')
-    extents_datasource = shp_driver.CreateDataSource(extents_path)
+    #: Both the extents and the fishnet polygons go in a single GeoPackage
+    #: rather than a set of shapefile sidecar files for each
+    gpkg_driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(gpkg_path):
+        gpkg_driver.DeleteDataSource(gpkg_path)
+    gpkg_ds = gpkg_driver.CreateDataSource(gpkg_path)
     srs = osr.SpatialReference()
     srs.ImportFromEPSG(epsg_code)
-    extents_layer = extents_datasource.CreateLayer('', srs, ogr.wkbPolygon)
+
+    #: Set up extents layer
+    extents_layer = gpkg_ds.CreateLayer(EXTENTS_LAYER, srs, ogr.wkbPolygon)
     extents_layer.CreateField(ogr.FieldDefn('file_name', ogr.OFTString))
 
-    #: Write the extents out to shapefile
+    #: Write the extents out in a single transaction
     defn = extents_layer.GetLayerDefn()
+    extents_layer.StartTransaction()
     for raster_filename in extents:
         feature = ogr.Feature(defn)
         feature.SetField('file_name', raster_filename)
-        poly = create_polygon(extents[raster_filename])
-        geom = ogr.CreateGeometryFromWkt(poly)
-        feature.SetGeometry(geom)
+        feature.SetGeometry(create_polygon(extents[raster_filename]))
         extents_layer.CreateFeature(feature)
         feature = None
-        poly = None
-        geom = None
+    extents_layer.CommitTransaction()
 
     extents_layer = None
-    extents_datasource = None
 
     # Create tiling scheme
     fishnet = create_fishnet_indices(ulx, uly, lrx, lry, fishnet_size)
-    # for cell in fishnet:
-    #     print(cell)
-
-    # Set up fishnet polygons shapefile
-    shp_driver = ogr.GetDriverByName('ESRI Shapefile')
-    shp_ds = shp_driver.CreateDataSource(shp_path)
-    srs = osr.SpatialReference()
 
-    srs.ImportFromEPSG(epsg_code)
-    layer = shp_ds.CreateLayer('', srs, ogr.wkbPolygon)
+    # Set up fishnet polygons layer
+    layer = gpkg_ds.CreateLayer(FISHNET_LAYER, srs, ogr.wkbPolygon)
     layer.CreateField(ogr.FieldDefn('raster', ogr.OFTString))
     layer.CreateField(ogr.FieldDefn('cell', ogr.OFTString))
     layer.CreateField(ogr.FieldDefn('d_to_cent', ogr.OFTReal))
     layer.CreateField(ogr.FieldDefn('nodatas', ogr.OFTReal))
     layer.CreateField(ogr.FieldDefn('override', ogr.OFTString))
+    for column in TILE_BOUNDS_COLUMNS:
+        layer.CreateField(ogr.FieldDefn(column, ogr.OFTReal))
+
+    #: Master columns containing info about every tile in our extent
+    all_tiles = {column: [] for column in TILE_COLUMNS}
+
+    #: Keep the sources' data type for the tiles (ie, Byte for 8-bit imagery)
+    #: if they all have the same type and all have a nodata value. Otherwise,
+    #: use Int16 so that the 256 nodata fallback fits. The tiles all need the
+    #: same type to be mosaiced together.
+    data_types = {raster_info[4] for raster_info in rasters.values()}
+    all_nodata = all(raster_info[3] is not None for raster_info in rasters.values())
+    if len(data_types) == 1 and all_nodata:
+        tile_type = data_types.pop()
+    else:
+        tile_type = gdal.GDT_Int16
 
-    #: Master dictionary containing info about every cell in our extent
-    all_cells = {}
-
-    counter = 0
-
-    # Loop through rectified rasters, create tiles named by index
-    for root, dirs, files in os.walk(rectified_dir):
-        total = len(files)
-        for fname in files:
-            if fname[-4:] == ".tif":
-                #print(fname)
-
-                #: Raster progress bar
-                counter +=1
-                percent = counter/total
-                gdal_progress_callback(percent, None, None)
-
-                raster_cells = copy_tiles_from_raster(root, fname, fishnet, layer,
-                                                      tiled_dir)
-
-                #: Merge raster's cells dictionary into master cells dictionary
-                for cell_index in raster_cells:
-                    #: If this cell index already exists, add the raster's tiles
-                    #: by extending the dictionary
-                    if cell_index in all_cells:
-                        all_cells[cell_index].update(raster_cells[cell_index])
-                    #: Otherwise, this raster has the first tiles for that cell
-                    else:
-                        all_cells[cell_index] = raster_cells[cell_index]
-
-                # all_cells.update(distances)
-
-                # # Update add or overwrite cell in chunks dictionary if it isn't
-                # # presnt already or if the distance is shorter than the current one
-                # # and the new chunk has fewer nodata values
-                # for cell, rname_distance in distances.items():
-                #     if cell in chunks:  # Is there a chunk for this cell already?
-                #         if rname_distance[1] < chunks[cell][1]:  # is this one closer to the center of the raster than the existing one?
-                #             if rname_distance[2] <= chunks[cell][2]:  # does this one have fewer nodatas (or the same as) that the existing one?
-                #                 chunks[cell] = rname_distance
-                #     elif cell not in chunks:
-                #         chunks[cell] = rname_distance
-
-    # Cleanup shapefile handles
+    # Tile each of the rectified rasters in its own process
+    if pool is None:
+        pool_context = ProcessPoolExecutor(max_workers=tiling_workers or os.cpu_count(),
+                                           initializer=init_tiling_worker)
+    else:
+        #: Leave a shared pool running for the caller's next run
+        pool_context = contextlib.nullcontext(pool)
+    with pool_context as executor:
+        #: Only send each worker the cells that overlap its raster rather
+        #: than pickling the whole fishnet for every raster
+        futures = []
+        for raster_path, raster_info in rasters.items():
+            futures.append(executor.submit(copy_tiles_from_raster, raster_path, raster_info,
+                                           overlapping_cells(fishnet, raster_info),
+                                           tiled_dir, tile_type))
+
+        #: Collect the results in the order the rasters were submitted so the
+        #: tile order (and thus the tie-breaking when sorting) doesn't depend
+        #: on which process finishes first. Only this process writes to the
+        #: GeoPackage, with all the features written in a single transaction.
+        defn = layer.GetLayerDefn()
+        total = len(futures)
+        layer.StartTransaction()
+        reset_progress()
+        for counter, future in enumerate(futures, 1):
+            raster_tiles, features, tile_vrts = future.result()
+
+            #: Write any in-memory tiles into this process's /vsimem
+            for tile_rastername, vrt_xml in tile_vrts:
+                gdal.FileFromMemBuffer(os.path.join(tiled_dir, tile_rastername), vrt_xml)
+
+            #: Add raster's tiles to the master columns
+            for column in TILE_COLUMNS:
+                all_tiles[column].extend(raster_tiles[column])
+
+            for rastername, cell_x, cell_y, distance, nodatas, coords, bounds in features:
+                feature = ogr.Feature(defn)
+                feature.SetField('raster', rastername)
+                feature.SetField('cell', f'{cell_x}-{cell_y}')
+                feature.SetField('d_to_cent', distance)
+                feature.SetField('nodatas', nodatas)
+                for column, value in zip(TILE_BOUNDS_COLUMNS, bounds):
+                    feature.SetField(column, value)
+                feature.SetGeometry(create_polygon(coords))
+                layer.CreateFeature(feature)
+                feature = None
+
+            #: Raster progress bar
+            gdal_progress_callback(counter / total, None, None)
+        layer.CommitTransaction()
+
+    # Cleanup GeoPackage handles
     layer = None
-    shp_ds = None
+    gpkg_ds = None
 
-    return all_cells
+    return pd.DataFrame(all_tiles, columns=TILE_COLUMNS)
 
 
-def read_tiles_from_shapefile(shp_path):
+def read_tiles_from_geopackage(gpkg_path):
     '''
-    Read the information for each specific cell from the mosaic shapefile.
+    Read the information for each specific cell from the fishnet layer of the
+    mosaic GeoPackage.
 
-    Returns: A double-nested dictionary read from the shapefile's features
-    containing all the information about each cell, formatted like thus:
-    {cell_index:
-        {tile_rastername:
-            {'distance':x,
-             'nodatas':y,
-             'override':True/False}
-        }
-    }
+    Returns: A pandas DataFrame with TILE_COLUMNS as columns and a row for
+    every tile read from the layer's features.
     '''
 
-    driver = ogr.GetDriverByName('ESRI Shapefile')
-    shape_s_dh = driver.Open(shp_path, 0)
-    layer = shape_s_dh.GetLayer()
+    driver = ogr.GetDriverByName('GPKG')
+    gpkg_ds = driver.Open(gpkg_path, 0)
+    layer = gpkg_ds.GetLayerByName(FISHNET_LAYER)
 
-    #{cell_index: {rastername: {distance:x, nodatas:x, override:x}}}
-    cells = {}
+    tiles = {column: [] for column in TILE_COLUMNS}
     #: Ever feature is a tile (identified by tile_rastername)
     for feature in layer:
         cell_index = feature.GetField("cell")
+        cell_x, cell_y = (int(i) for i in cell_index.split('-'))
         rastername = feature.GetField("raster")
         distance = feature.GetField("d_to_cent")
         nodatas = feature.GetField("nodatas")
@@ -560,77 +594,198 @@ def read_tiles_from_shapefile(shp_path):
         override = False
         if override_text and override_text.casefold() == 'y':
             override = True
-        tile_rastername = "{}_{}.tif".format(cell_index, rastername[:-4])
+        tile_rastername = "{}_{}.vrt".format(cell_index, rastername[:-4])
 
-        tile_dict = {'distance': distance,
-                     'nodatas': nodatas,
-                     'override': override}
-
-        #: If the cell already exists, add tile dictionary to that cell's dict
-        if cell_index in cells:
-            cells[cell_index][tile_rastername] = tile_dict
-        #: Otherwise, create new sub-dict for that cell and add tile dictionary
-        else:
-            cells[cell_index] = {tile_rastername: tile_dict}
+        tiles['cell_x'].append(cell_x)
+        tiles['cell_y'].append(cell_y)
+        tiles['tile_rastername'].append(tile_rastername)
+        tiles['distance'].append(distance)
+        tiles['nodatas'].append(nodatas)
+        tiles['override'].append(override)
+        for column in TILE_BOUNDS_COLUMNS:
+            tiles[column].append(feature.GetField(column))
 
     layer = None
-    shape_s_dh = None
+    gpkg_ds = None
 
-    return cells
+    return pd.DataFrame(tiles, columns=TILE_COLUMNS)
 
 
-def sort_tiles(cell):
+def sort_tiles(tiles):
     '''
-    Sort the source raster tiles in a single cell based on distance to center
+    Sort the source raster tiles in every cell based on distance to center
     then # of nodatas, overriding where indicated.
-    'cell' is a nested dictionary, the inner dictionaries of the master cells
-    dictionary, and is formatted thus:
-    {tile_rastername:
-        {'distance':x,
-         'nodatas':y,
-         'override':True/False}
-    }
-
-    returns a list of sorted tiles, with the outer key (tile_rastername)
-    being added to the inner dictionary as a value with the same name (so
-    there's now a list of dicts, rather than a nested dict):
-    [{'tile_rastername':x, 'distance':y, 'nodatas':z, 'override':a}, {...}, ...]
-    '''
-
-    #: First, convert nested dictionary to list of dictionaries while inserting
-    #: tile_rastername as a value of the dictionary
-    tile_list = []
-    for tile_rastername in cell:
-        tile_list.append({'tile_rastername': tile_rastername,
-                          'distance': cell[tile_rastername]['distance'],
-                          'nodatas':cell[tile_rastername]['nodatas'],
-                          'override':cell[tile_rastername]['override']
-                          })
-
-    #: First, sort out an override tile if present
-    #: Assumes there is only 1 or 0 override tiles (only takes the first 
-    #: override tile it finds)
-    tile_list.sort(key=lambda tile_dict: tile_dict['override'], reverse=True)
-    if tile_list[0]['override']:
-        sorted_list = tile_list[:1]
-        distance_list = tile_list[1:]
-    else:
-        sorted_list = []
-        distance_list = tile_list
+    'tiles' is the master tiles DataFrame (TILE_COLUMNS).
+
+    Within a cell, an override tile is the most desirable, followed by the
+    tile closest to the center of its source raster, followed by the rest
+    from least to most nodatas. Assumes there is only 1 or 0 override tiles
+    per cell (only takes the first override tile it finds).
+
+    returns a DataFrame of the same tiles, sorted by cell (in the order the
+    cells were found) with the most desirable tile in each cell last so that
+    the VRT adds it on top.
+    '''
+
+    tiles = tiles.reset_index(drop=True)
+    tile_count = len(tiles)
+    #: An empty table's columns are object dtype, so ask for bools explicitly
+    overrides = tiles['override'].to_numpy(dtype=bool)
+
+    #: Ties are broken by the order the tiles were found, with any override
+    #: tiles moved to the front
+    found_order = np.lexsort((np.arange(tile_count), ~overrides))
+    tiles['tie_breaker'] = np.argsort(found_order)
+
+    #: 0 for the override tile, 1 for the closest tile, 2 for the rest
+    priority = np.full(tile_count, 2)
+    override_tiles = tiles[overrides].sort_values('tie_breaker')
+    first_overrides = override_tiles.groupby(['cell_x', 'cell_y'], sort=False).head(1).index
+    priority[first_overrides] = 0
+    distance_tiles = tiles.drop(first_overrides).sort_values(['distance', 'tie_breaker'])
+    priority[distance_tiles.groupby(['cell_x', 'cell_y'], sort=False).head(1).index] = 1
+
+    #: Sort everything at once: by cell, then from least to most desirable.
+    #: lexsort uses the last key as the primary key.
+    cell_order = tiles.groupby(['cell_x', 'cell_y'], sort=False).ngroup().to_numpy()
+    z_order = np.lexsort((-tiles['tie_breaker'].to_numpy(),
+                          -tiles['distance'].to_numpy(),
+                          -tiles['nodatas'].to_numpy(),
+                          -priority,
+                          cell_order))
+
+    return tiles.iloc[z_order].drop(columns='tie_breaker')
+
+
+def build_tile_index(index_path, tile_paths, tiles):
+    '''
+    Write a GDAL Raster Tile Index (GTI) GeoPackage for the tiles in
+    tile_paths, which must already be in z-order (most desirable tile last,
+    same as the VRT). tiles is the matching (same order) tiles DataFrame,
+    which holds each tile's footprint and resolution. Each feature is the
+    footprint of a single tile with its path in the 'location' field and its
+    position in the z-order in the 'z_order' field.
+
+    The GTI driver (GDAL >= 3.9) reads the index directly, only opening the
+    tiles that intersect the area being read, instead of parsing a VRT with a
+    source entry for every tile.
+    '''
+
+    if not tile_paths:
+        raise ValueError(f'No tiles to add to tile index {index_path}')
+
+    driver = ogr.GetDriverByName('GPKG')
+    if os.path.exists(index_path):
+        driver.DeleteDataSource(index_path)
+
+    #: All the tiles share the sources' projection, so only open one of them
+    t_fh = gdal.Open(tile_paths[0], gdal.GA_ReadOnly)
+    projection = t_fh.GetProjection()
+    t_fh = None
+
+    index_ds = driver.CreateDataSource(index_path)
+    srs = None
+    if projection:
+        srs = osr.SpatialReference()
+        srs.ImportFromWkt(projection)
+    layer = index_ds.CreateLayer('tiles', srs, ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn('location', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('z_order', ogr.OFTInteger))
+
+    #: Tell the GTI driver which fields to use and the resolution of the
+    #: mosaic (average of the tiles, same as gdal.BuildVRT's default)
+    layer.SetMetadataItem('LOCATION_FIELD', 'location')
+    layer.SetMetadataItem('SORT_FIELD', 'z_order')
+    layer.SetMetadataItem('SORT_FIELD_ASC', 'YES')
+    layer.SetMetadataItem('RESX', str(tiles['res_x'].mean()))
+    layer.SetMetadataItem('RESY', str(tiles['res_y'].mean()))
+
+    bounds = tiles[['tile_xmin', 'tile_ymin', 'tile_xmax', 'tile_ymax']].to_numpy().tolist()
+
+    defn = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for z_order, (tile_path, (xmin, ymin, xmax, ymax)) in enumerate(zip(tile_paths, bounds)):
+        feature = ogr.Feature(defn)
+        feature.SetField('location', tile_path)
+        feature.SetField('z_order', z_order)
+        feature.SetGeometry(create_polygon([(xmin, ymax),
+                                            (xmax, ymax),
+                                            (xmax, ymin),
+                                            (xmin, ymin),
+                                            (xmin, ymax)]))
+        layer.CreateFeature(feature)
+        feature = None
+    layer.CommitTransaction()
+
+    layer = None
+    index_ds = None
+
 
-    #: Next, sort out the shortest distance
-    distance_list.sort(key=lambda tile_dict: tile_dict['distance'])
-    sorted_list.extend(distance_list[:1])
-    nodatas_list = distance_list[1:]
+def find_files_by_prefix(directory, prefixes):
+    '''
+    Yield the paths of every file in directory whose name starts with one of
+    prefixes as the directory is read (only once).
+    '''
+
+    prefixes = tuple(prefixes)
+
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(prefixes):
+                yield entry.path
+
+
+def unlink_if_exists(file_path):
+    '''
+    Delete file_path, returning False instead of raising if it's already gone.
+    '''
 
-    #: Finally, sort the remaining from least to most nodatas
-    nodatas_list.sort(key=lambda tile_dict: tile_dict['nodatas'])
-    sorted_list.extend(nodatas_list)
+    try:
+        os.unlink(file_path)
+    except FileNotFoundError:
+        return False
 
-    return sorted_list
+    return True
 
 
-def run(source_dir, output_dir, name, fishnet_size, cleanup=False, tile=True):
+def delete_files(directory, file_paths):
+    '''
+    Delete file_paths (in directory, which is only used for reporting)
+    concurrently; each unlink on a network share is a round trip, so issuing
+    them from several threads keeps the connection busy. Files that have
+    already disappeared are skipped.
+    '''
+
+    #: Start each unlink as soon as its path comes in (file_paths may be a
+    #: generator still reading the directory), skipping duplicates so the
+    #: same file isn't unlinked twice
+    seen = set()
+    futures = []
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        for file_path in file_paths:
+            file_path = os.fspath(file_path)
+            if file_path not in seen:
+                seen.add(file_path)
+                futures.append(executor.submit(unlink_if_exists, file_path))
+
+    deleted = sum(future.result() for future in futures)
+
+    #: One line for the lot; printing every sidecar file is slow on Windows
+    #: consoles and just scrolls the progress output away
+    if deleted:
+        print(f'Deleted {deleted} files from {directory}')
+
+
+def delete_files_by_prefix(directory, prefixes):
+    '''
+    Delete every file in directory whose name starts with one of prefixes.
+    '''
+
+    delete_files(directory, find_files_by_prefix(directory, prefixes))
+
+
+def run(source_dir, output_dir, name, fishnet_size, cleanup=False, tile=True, max_tiles=None, pool=None,
+        tiling_workers=None):
     '''
     Main logic; (eventually) all calls to other functions will come from this
     function. Designed to either manually call with arguments or to be called
@@ -640,7 +795,7 @@ def run(source_dir, output_dir, name, fishnet_size, cleanup=False, tile=True):
                         rasters to be mosaiced.
     output_dir:         A pathlib.Path object to the output directory for the
                         mosaiced tif. Will also hold the temporary tiled
-                        directory, mosaic csv, and fishnet shapefile.
+                        directory, mosaic csv, and fishnet GeoPackage.
     name:               The name for the output raster without any extension
                         (ie, 'foo', not 'foo.tif'). Also used to name the
                         temporary/intermediate data.
@@ -648,23 +803,57 @@ def run(source_dir, output_dir, name, fishnet_size, cleanup=False, tile=True):
     cleanup:            If true, delete all temporary/intermediate data.
     tile:               If true, source rasters will be tiled into a temporary
                         directory within output_dir. If false, info required
-                        for sorting will be read from the fishnet shapefile
+                        for sorting will be read from the fishnet GeoPackage
                         created earlier.
+    max_tiles:          If set, only this many of the most desirable tiles in
+                        each cell are added to the mosaic; the rest would
+                        only show through nodata areas of the tiles above
+                        them. None (the default) uses every tile. Every
+                        tile is still created (its nodatas are needed to
+                        rank it); this only trims what the mosaic reads.
+    pool:               An optional ProcessPoolExecutor (initialized with
+                        init_tiling_worker) to tile in, so that several runs
+                        can share one set of worker processes. By default
+                        each run starts its own.
+    tiling_workers:     The number of processes for a run's own tiling pool
+                        (ignored if pool is given). Defaults to one per core.
     '''
 
-    start = datetime.datetime.now()
+    start = time.perf_counter()
+
+    #: Neighboring tiles share source raster blocks (every tile overreads its
+    #: cell by 5 pixels and usually covers only part of a block), so give
+    #: GDAL's block cache enough room to keep them resident while the mosaic
+    #: is read instead of re-reading them from disk for each tile. Only ever
+    #: raise the cache (GDAL's default is 5% of RAM) and leave it alone if
+    #: the user set GDAL_CACHEMAX.
+    if not gdal.GetConfigOption('GDAL_CACHEMAX'):
+        gdal.SetCacheMax(max(gdal.GetCacheMax(), 1 << 30))
 
     #: Paths
-    poly_path = output_dir/f'{name}_mosaic.shp'
+    poly_path = output_dir/f'{name}_mosaic.gpkg'
     tile_path = output_dir/f'{name}_tiled'
     csv_path = output_dir/f'{name}_mosaic.csv'
     vrt_path = output_dir/f'{name}.vrt'
+    index_path = output_dir/f'{name}_index.gti.gpkg'
     tif_path = output_dir/f'{name}.tif'
-    extents_path = output_dir/f'{name}_extents.shp'
+
+    #: String forms for the per-file work below; joining strings is much
+    #: cheaper than building a Path for every tile or directory entry
+    output_dir_str = os.fspath(output_dir)
+
+    #: Tiles that are going to be deleted at the end anyway are kept in GDAL's
+    #: in-memory filesystem instead of on disk (an override run needs them on
+    #: disk, so they're only in memory when retiling and cleaning up)
+    tiles_in_memory = tile and cleanup
+    if tiles_in_memory:
+        tile_dir_str = f'/vsimem/{name}_tiled'
+    else:
+        tile_dir_str = os.fspath(tile_path)
 
     print(f'\nMerging {source_dir} into {tif_path}\n')
 
-    # Retile if needed; otherwise, just read the shapefile
+    # Retile if needed; otherwise, just read the GeoPackage
     if tile:
         #: File path management
         if not output_dir.exists():
@@ -673,120 +862,192 @@ def run(source_dir, output_dir, name, fishnet_size, cleanup=False, tile=True):
         if tile_path.exists():
             print(f'Deleting existing tile directory {tile_path}...')
             shutil.rmtree(tile_path)
-        tile_path.mkdir(parents=True)
-
-        files = []
-        #: Add all .tif related files, including .tif.xml and .tif.ovr
-        files.extend([tif for tif in output_dir.glob(f'{name}.tif*')])
-        #: Add CSV and all shapefile files
-        files.extend([shp for shp in output_dir.glob(f'{name}_mosaic.*')])
-        files.extend([shp for shp in output_dir.glob(f'{name}_extents.*')])
-        for file_path in files:
-            if file_path.exists():  #: 3.8 will allow unlink(missing_ok=True)
-                print(f'Deleting {file_path}...')
-                file_path.unlink()
-
-        print(f'\nTiling source rasters into {tile_path}...')
-        all_cells = generate_tiles_from_rasters(str(source_dir), str(extents_path), str(poly_path), str(tile_path), fishnet_size)
+        if not tiles_in_memory:
+            tile_path.mkdir(parents=True)
+
+        #: All .tif related files, including .tif.xml and .tif.ovr, the CSV
+        #: and the GeoPackage
+        delete_files_by_prefix(output_dir_str, (f'{name}.tif', f'{name}_mosaic.'))
+
+        print(f'\nTiling source rasters into {tile_dir_str}...')
+        all_tiles = generate_tiles_from_rasters(str(source_dir), str(poly_path), tile_dir_str, fishnet_size, pool, tiling_workers)
 
     else:
         #: Existing override cleanup
-        files = []
-        files.extend([f for f in output_dir.glob(f'{name}_overrides.*')])
-        files.extend([f for f in output_dir.glob(f'{name}_mosaic_overrides.*')])
-        for file_path in files:
-            if file_path.exists():  #: 3.8 will allow unlink(missing_ok=True)
-                print(f'Deleting {file_path}...')
-                file_path.unlink()
+        delete_files_by_prefix(output_dir_str, (f'{name}_overrides.', f'{name}_mosaic_overrides.'))
 
         print(f'\nReading existing tiles from {poly_path}...')
 
         csv_path = output_dir/f'{name}_mosaic_overrides.csv'
         vrt_path = output_dir/f'{name}_overrides.vrt'
+        index_path = output_dir/f'{name}_overrides_index.gti.gpkg'
         tif_path = output_dir/f'{name}_overrides.tif'
-        all_cells = read_tiles_from_shapefile(str(poly_path))
+        all_tiles = read_tiles_from_geopackage(str(poly_path))
 
-    #: Create list of sorted dictionaries. The dictionaries for each cell are
-    #: flattened and then sorted by distance and then nodatas (first is always
-    #: shortest distance, following are sorted by distance then nodatas)
+    #: Nothing to mosaic (no .tif files in source_dir, or an empty fishnet
+    #: layer); stop here rather than failing later on an empty mosaic
+    if all_tiles.empty:
+        raise ValueError(f'No tiles found for {source_dir}')
+
+    #: Sort the tiles in each cell by distance and then nodatas (most
+    #: desirable is always shortest distance, following are sorted by
+    #: nodatas), keeping the cells in the order they were found
     print(f'\nSorting tiles...')
-    sorted_tiles = []
-    for cell_index in all_cells:
-        cell_tiles = sort_tiles(all_cells[cell_index])
-        cell_tiles.reverse()  #: reverse so VRT adds most desirable chunks last
-        sorted_tiles.extend(cell_tiles)
+    sorted_tiles = sort_tiles(all_tiles)
 
-    with open(csv_path, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        for tile in sorted_tiles:
-            tile_name = tile['tile_rastername']
-            full_tile_path = tile_path/tile_name
-            writer.writerow([full_tile_path])
+    #: Drop the tiles buried under the most desirable ones (the most desirable
+    #: tiles are last in each cell)
+    if max_tiles is not None:
+        sorted_tiles = sorted_tiles.groupby(['cell_x', 'cell_y'], sort=False).tail(max_tiles)
 
-    #: Build list of files for vrt
-    vrt_list = [str(tile_path/tile['tile_rastername']) for tile in sorted_tiles]
+    #: Build list of files for vrt, used for both the CSV and the mosaic.
+    #: (gdal.BuildVRT can't read the CSV itself; -input_file_list is only
+    #: parsed by the gdalbuildvrt command line utility.)
+    vrt_list = [os.path.join(tile_dir_str, tile_name) for tile_name in sorted_tiles['tile_rastername']]
     # vrt_options = gdal.BuildVRTOptions(resampleAlg='cubic')
 
-    #: Build VRT
-    print(f'\nBuilding {vrt_path}...')
-    vrt = gdal.BuildVRT(str(vrt_path), vrt_list, callback=gdal_progress_callback)
-    vrt = None
-
-    creation_opts = ['compress=jpeg', 'photometric=ycbcr', 'tiled=yes']
-
-    print(f'\nTranslating to {tif_path}...')
-    trans_opts = gdal.TranslateOptions(format='GTiff',
-                                       creationOptions=creation_opts,
-                                       outputType=gdal.GDT_Byte,
-                                       scaleParams=[],
-                                       callback=gdal_progress_callback)
-    dataset = gdal.Translate(str(tif_path), str(vrt_path), options=trans_opts)
-    dataset = None
-
-    print('\nBuilding overviews...')
-    #: Set options for compressed overviews
-    gdal.SetConfigOption('compress_overview', 'jpeg')
-    gdal.SetConfigOption('photometric_overview', 'ycbcr')
-    gdal.SetConfigOption('interleave_overview', 'pixel')
-
-    #: Opening read-only creates external overviews (.ovr file)
-    dataset = gdal.Open(str(tif_path), gdal.GA_ReadOnly)
-    dataset.BuildOverviews('cubic', [2, 4, 8, 16], gdal_progress_callback)
-    dataset = None
+    with open(csv_path, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerows([full_tile_path] for full_tile_path in vrt_list)
+
+    #: Use a GTI tile index if this GDAL has the driver (3.9+); otherwise,
+    #: build a VRT of all the tiles
+    if gdal.GetDriverByName('GTI'):
+        print(f'\nBuilding tile index {index_path}...')
+        build_tile_index(str(index_path), vrt_list, sorted_tiles)
+        mosaic_path = index_path
+    else:
+        print(f'\nBuilding {vrt_path}...')
+        reset_progress()
+        vrt = gdal.BuildVRT(str(vrt_path), vrt_list, callback=gdal_progress_callback)
+        vrt = None
+        mosaic_path = vrt_path
+
+    #: Use the COG driver if this GDAL has it (3.1+); it writes the tiled,
+    #: jpeg-compressed tif and its internal overviews in a single pass.
+    #: Otherwise, translate to a GTiff and build the overviews afterwards.
+    if gdal.GetDriverByName('COG'):
+        #: COG uses YCbCr for 3-band jpeg automatically
+        creation_opts = ['compress=jpeg', 'overviews=auto', 'overview_resampling=cubic',
+                         'bigtiff=if_safer']
+
+        print(f'\nTranslating to {tif_path} (with overviews)...')
+        trans_opts = gdal.TranslateOptions(format='COG',
+                                           creationOptions=creation_opts,
+                                           outputType=gdal.GDT_Byte,
+                                           scaleParams=[],
+                                           callback=gdal_progress_callback)
+        reset_progress()
+        dataset = gdal.Translate(str(tif_path), str(mosaic_path), options=trans_opts)
+        dataset = None
+
+    else:
+        creation_opts = ['compress=jpeg', 'photometric=ycbcr', 'tiled=yes']
+
+        print(f'\nTranslating to {tif_path}...')
+        trans_opts = gdal.TranslateOptions(format='GTiff',
+                                           creationOptions=creation_opts,
+                                           outputType=gdal.GDT_Byte,
+                                           scaleParams=[],
+                                           callback=gdal_progress_callback)
+        reset_progress()
+        dataset = gdal.Translate(str(tif_path), str(mosaic_path), options=trans_opts)
+        dataset = None
+
+        print('\nBuilding overviews...')
+        #: Set options for compressed overviews
+        gdal.SetConfigOption('compress_overview', 'jpeg')
+        gdal.SetConfigOption('photometric_overview', 'ycbcr')
+        gdal.SetConfigOption('interleave_overview', 'pixel')
+
+        #: Opening for update writes the overviews inside the tif instead of
+        #: an external .ovr file, which also helps downstream reads
+        dataset = gdal.Open(str(tif_path), gdal.GA_Update)
+        reset_progress()
+        dataset.BuildOverviews('cubic', [2, 4, 8, 16], gdal_progress_callback)
+        dataset = None
 
     #: Cleanup our files after running
     if cleanup:
         print('\nCleaning up after ourselves...\n')
-        if tile_path.exists():
-            print(f'Deleting existing tile directory {tile_path}...')
-            shutil.rmtree(tile_path)
 
-        files = []
-        #: Add CSV and all shapefile files
-        files.extend([shp for shp in output_dir.glob(f'{name}_mosaic.*')])
-        files.extend([shp for shp in output_dir.glob(f'{name}_extents.*')])
-        for file_path in files:
-            if file_path.exists():  #: 3.8 will allow unlink(missing_ok=True)
-                print(f'Deleting {file_path}...')
-                file_path.unlink()
+        #: Nothing after this reads the tiles, so let the (slow, one unlink
+        #: per tile) delete of the tile directory run alongside the rest of
+        #: the cleanup. Leaving the with block waits for it, so it's done
+        #: before run() returns (and before a rerun recreates the directory).
+        tile_delete = None
+        with ThreadPoolExecutor(max_workers=1) as tile_delete_executor:
+            if tiles_in_memory:
+                gdal.RmdirRecursive(tile_dir_str)
+            elif tile_path.exists():
+                print(f'Deleting existing tile directory {tile_path}...')
+                tile_delete = tile_delete_executor.submit(shutil.rmtree, tile_path)
+
+            mosaic_prefix = f'{poly_path.stem}.'
+
+            #: The CSV and the GeoPackage (and any -wal/-shm files left with
+            #: it), the mosaic VRT and the tile index
+            delete_files(output_dir_str, itertools.chain(find_files_by_prefix(output_dir_str, (mosaic_prefix,)),
+                                                         [csv_path, vrt_path, index_path]))
 
-        shpfiles_paths = output_dir.glob(f'{poly_path.stem}.*')
+        #: Raise any error from deleting the tiles rather than silently
+        #: leaving them behind
+        if tile_delete:
+            tile_delete.result()
 
-        for file_path in [csv_path, vrt_path]:
-            if file_path.exists():
-                file_path.unlink()
+    elapsed = datetime.timedelta(seconds=time.perf_counter() - start)
 
-    end = datetime.datetime.now()
+    print(f'\n{tif_path} took {elapsed} to complete.', flush=True)
 
-    print(f'\n{tif_path} took {end-start} to complete.')
 
+def run_city(year_path, output_root_path, fishnet_size, cleanup, tile, max_tiles=None, pool=None,
+             tiling_workers=None):
+    '''
+    Derive the output directory and file name for a single city/year
+    directory (.../city/year) and run() it. Lives at the module level so that
+    it can be sent to a worker process.
+    '''
+
+    #: Paths
+    year_dir = Path(year_path)
+    output_root_dir = Path(output_root_path)
 
-if "__main__" in __name__:
+    year = year_dir.name
+    city = year_dir.parent.name
+    output_dir = output_root_dir/city
+    filename = f'{city}{year}'
 
-    cleanup = False  #: Set to False to keep temp files for troubleshooting
-    fishnet_size = 10  #: in map units
-    tile = True  #: Set to False to read data on existing tiles from shapefile
+    run(year_dir, output_dir, filename, fishnet_size, cleanup, tile=tile, max_tiles=max_tiles, pool=pool,
+        tiling_workers=tiling_workers)
+
+
+def positive_int(text):
+    '''
+    argparse type for options that must be a whole number of at least 1.
+    '''
 
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'must be at least 1, not {value}')
+
+    return value
+
+
+def positive_float(text):
+    '''
+    argparse type for options that must be a number greater than 0.
+    '''
+
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f'must be greater than 0, not {value}')
+
+    return value
+
+
+if __name__ == '__main__':
+
+    #: Defaults for running without arguments
     # years = [r'C:\gis\Projects\Sanborn\marriott_tif\Sandy\1898',
     #          r'C:\gis\Projects\Sanborn\marriott_tif\Sandy\1911',
     #          r'C:\gis\Projects\Sanborn\marriott_tif\Scofield\1924',
@@ -805,17 +1066,48 @@ if "__main__" in __name__:
     #          ]
 
     years = [r'c:\gis\projects\sanborn\marriott_tif\Salt Lake City\1950']
-
-    for city in years:
-
-        #: Paths
-        # year_dir = Path(r'C:\gis\Projects\Sanborn\marriott_tif\Green River\1917')
-        year_dir = Path(city)
-        output_root_dir = Path(r'F:\WasatchCo\sanborn2')
-
-        year = year_dir.name
-        city = year_dir.parent.name
-        output_dir = output_root_dir/city
-        filename = f'{city}{year}'
-
-        run(year_dir, output_dir, filename, fishnet_size, cleanup, tile=False)
+    output_root_dir = r'F:\WasatchCo\sanborn2'
+
+    parser = argparse.ArgumentParser(description='Merge the rectified rasters for one or more city/year directories into mosaics.')
+    parser.add_argument('--year-dir', nargs='+', default=years, help='one or more .../city/year directories of source rasters')
+    parser.add_argument('--output-root', default=output_root_dir, help='outputs are written to a directory per city under this one')
+    parser.add_argument('--fishnet-size', type=positive_float, default=10, help='size of the fishnet cells, in map units')
+    parser.add_argument('--cleanup', action=argparse.BooleanOptionalAction, default=False,
+                        help='delete the intermediate files (turn off to keep them for troubleshooting)')
+    parser.add_argument('--tile', action=argparse.BooleanOptionalAction, default=False,
+                        help='retile the source rasters, replacing the mosaic GeoPackage and any override edits in it '
+                             '(default: read the existing tiles from the GeoPackage)')
+    parser.add_argument('--jobs', type=positive_int, default=None,
+                        help='number of cities to run at once (default: half the cores, at most one per city)')
+    parser.add_argument('--max-tiles', type=positive_int, default=None,
+                        help='only add this many of the most desirable tiles in each cell to the mosaic (default: all)')
+    args = parser.parse_args()
+
+    #: Validate the paths once up front instead of failing partway through
+    try:
+        year_dirs = [Path(year_dir).resolve(strict=True) for year_dir in args.year_dir]
+    except FileNotFoundError as error:
+        parser.error(f'year directory not found: {error.filename}')
+    output_root = Path(args.output_root).resolve()
+
+    #: Each city is independent, so run them in separate processes, using up
+    #: to half the cores for cities by default. Each city then tiles in its
+    #: own pool, so the cores are split between the cities' pools to keep
+    #: the total number of GDAL processes at about one per core.
+    workers = args.jobs or max(1, min(len(year_dirs), os.cpu_count() // 2))
+    if workers == 1:
+        #: Running the cities one after another, so they can all tile in the
+        #: same pool instead of starting (and importing GDAL in) a new set of
+        #: worker processes for every city
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_tiling_worker) as pool:
+            for year_dir in year_dirs:
+                run_city(year_dir, output_root, args.fishnet_size, args.cleanup, args.tile,
+                         max_tiles=args.max_tiles, pool=pool)
+    else:
+        tiling_workers = max(1, os.cpu_count() // workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(run_city, year_dir, output_root, args.fishnet_size, args.cleanup,
+                                       args.tile, max_tiles=args.max_tiles, tiling_workers=tiling_workers)
+                       for year_dir in year_dirs]
+            for future in futures:
+                future.result()